@@ -31,7 +31,7 @@ async def startup_event():
     logger.info("🔍 Checking environment variables on startup:")
     for var in ENV_VARS_TO_CHECK:
         value = os.getenv(var)
-        logger.info(f"{var}: {'set' if value else 'NOT SET'}")
+        logger.info("%s: %s", var, "set" if value else "NOT SET")
 
 @app.get("/check_env/")
 async def check_env():
@@ -42,94 +42,376 @@ async def check_env():
 
 
 
-# from fastapi import FastAPI, UploadFile, File, HTTPException
-# from supabase import create_client, Client
-# import openai
+# from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Response
+# from openai import AsyncOpenAI
 # import os
-# from pypdf import PdfReader
+# import asyncpg
+# import pypdfium2 as pdfium
+# from concurrent.futures import ProcessPoolExecutor
+# import multiprocessing
+# from multiprocessing import shared_memory
+# from collections import OrderedDict
+# import asyncio
+# import functools
+# import io
+# import tempfile
+# import uuid
+# from typing import BinaryIO
+# import numpy as np
+# import tiktoken
 # import hashlib
+# from blake3 import blake3
 # import logging
 # import time
 
 # logging.basicConfig(level=logging.INFO)
+# logger = logging.getLogger(__name__)
 
-# logging.info(f"OPENAI_API_KEY: {'set' if os.getenv('OPENAI_API_KEY') else 'NOT SET'}")
-# logging.info(f"SUPABASE_URL: {'set' if os.getenv('SUPABASE_URL') else 'NOT SET'}")
-# logging.info(f"SUPABASE_SERVICE_ROLE_KEY: {'set' if os.getenv('SUPABASE_SERVICE_ROLE_KEY') else 'NOT SET'}")
+# logger.info("OPENAI_API_KEY: %s", "set" if os.getenv("OPENAI_API_KEY") else "NOT SET")
+# logger.info("SUPABASE_URL: %s", "set" if os.getenv("SUPABASE_URL") else "NOT SET")
+# logger.info("SUPABASE_SERVICE_ROLE_KEY: %s", "set" if os.getenv("SUPABASE_SERVICE_ROLE_KEY") else "NOT SET")
 
 # app = FastAPI()
 
 # # Load environment variables (optional if you use os.environ directly)
 # OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 # EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "text-embedding-3-small")
-# SUPABASE_URL = os.getenv("SUPABASE_URL")
-# SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+# SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")  # direct Postgres connection string
 
-# if not (OPENAI_API_KEY and SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY):
+# if not (OPENAI_API_KEY and SUPABASE_DB_URL):
 #     raise Exception("Missing environment variables for OpenAI or Supabase")
 
-# openai.api_key = OPENAI_API_KEY
-# supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
-
-# def extract_text_from_pdf(file_bytes: bytes) -> str:
-#     reader = PdfReader(file_bytes)
-#     text = ""
-#     for page in reader.pages:
-#         text_page = page.extract_text()
-#         if text_page:
-#             text += text_page + "\n"
-#     return text.strip()
-
-# def get_embedding(text: str):
-#     response = openai.Embedding.create(
-#         input=text,
-#         model=EMBEDDING_MODEL_NAME
+# # Module-level client so HTTP connections are pooled across requests
+# openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+# # Created on startup so they live on the server's event loop
+# db_pool: asyncpg.Pool = None
+# prune_task: asyncio.Task = None
+
+# @app.on_event("startup")
+# async def init_clients():
+#     global db_pool, prune_task
+#     db_pool = await asyncpg.create_pool(
+#         SUPABASE_DB_URL,
+#         min_size=10,
+#         max_size=50,
+#         max_inactive_connection_lifetime=300
 #     )
-#     return response['data'][0]['embedding']
+#     prune_task = asyncio.create_task(prune_jobs())
+
+# @app.on_event("shutdown")
+# async def close_clients():
+#     prune_task.cancel()
+#     await db_pool.close()
+
+# UPLOAD_CHUNK_SIZE = 1 << 20
+
+# # Page extraction is CPU-bound, so run it in worker processes to keep the event loop free.
+# # PDFium is not thread-safe and pypdfium2 does no locking, so concurrent threads are unsafe: use processes.
+# PDF_WORKERS = min(os.cpu_count() or 1, 4)
+# # Workers start lazily on the first upload, after the server's threadpool exists; forking a threaded
+# # process can deadlock on locks held at fork time, so start them from a clean forkserver instead
+# pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("forkserver"))
+
+# # Each task handles one contiguous slice of the pages, so every worker opens the document once per file;
+# # one task per page cost more in IPC than it saved
+# def _extract_pages(shm_name: str, size: int, part: int, parts: int) -> str:
+#     shm = shared_memory.SharedMemory(name=shm_name)
+#     try:
+#         pdf_bytes = bytes(shm.buf[:size])
+#     finally:
+#         shm.close()
+#     with pdfium.PdfDocument(pdf_bytes) as pdf:
+#         page_count = len(pdf)
+#         start, end = page_count * part // parts, page_count * (part + 1) // parts
+#         texts = [pdf[i].get_textpage().get_text_range() for i in range(start, end)]
+#     return "\n".join(t for t in texts if t)
+
+# async def extract_text_from_pdf(pdf_file: BinaryIO) -> str:
+#     size = pdf_file.seek(0, io.SEEK_END)
+#     # Copy the PDF into shared memory once so workers map it instead of unpickling a copy per task
+#     shm = shared_memory.SharedMemory(create=True, size=size)
+#     try:
+#         pdf_file.seek(0)
+#         offset = 0
+#         while chunk := pdf_file.read(UPLOAD_CHUNK_SIZE):
+#             shm.buf[offset:offset + len(chunk)] = chunk
+#             offset += len(chunk)
+#         loop = asyncio.get_running_loop()
+#         parts_text = await asyncio.gather(*[
+#             loop.run_in_executor(pdf_executor, _extract_pages, shm.name, size, part, PDF_WORKERS)
+#             for part in range(PDF_WORKERS)
+#         ])
+#     finally:
+#         shm.close()
+#         shm.unlink()
+#     return "\n".join(t for t in parts_text if t).strip()
+
+# # The embedding model caps inputs at 8191 tokens, so long documents are split on token boundaries
+# CHUNK_TOKENS = 512
+
+# # Loaded on first use: tiktoken downloads the BPE file, which must not be able to break import
+# @functools.lru_cache(maxsize=None)
+# def get_tokenizer() -> tiktoken.Encoding:
+#     try:
+#         return tiktoken.encoding_for_model(EMBEDDING_MODEL_NAME)
+#     except KeyError:
+#         return tiktoken.get_encoding("cl100k_base")
+
+# def chunk_text(text: str) -> list[str]:
+#     tokenizer = get_tokenizer()
+#     tokens = tokenizer.encode(text)
+#     chunks = []
+#     start = 0
+#     while start < len(tokens):
+#         end = min(start + CHUNK_TOKENS, len(tokens))
+#         # A token can hold part of a multi-byte character; back off until the chunk ends on a whole one
+#         while True:
+#             try:
+#                 chunks.append(tokenizer.decode_bytes(tokens[start:end]).decode("utf-8"))
+#                 break
+#             except UnicodeDecodeError:
+#                 if end - start <= 1:
+#                     raise
+#                 end -= 1
+#         start = end
+#     return chunks
+
+# # Inputs per embeddings request (kept well under the per-request token limit),
+# # and how many requests may be in flight at once so we stay inside the rate limit
+# EMBEDDING_BATCH_SIZE = 256
+# embedding_semaphore = asyncio.Semaphore(16)
+
+# async def _embed_batch(texts: list[str]) -> list[list[float]]:
+#     async with embedding_semaphore:
+#         response = await openai_client.embeddings.create(
+#             input=texts,
+#             model=EMBEDDING_MODEL_NAME
+#         )
+#     return [d.embedding for d in response.data]
+
+# # Bounded LRU of embeddings keyed by (model, chunk hash), so repeated chunks are not re-embedded.
+# # Entries are FP16 bytes (3 KB per vector, ~30 MB at the cap). That loses nothing: the embedding
+# # column is halfvec and format_vector rounds to FP16 anyway, so a hit and a miss store the same vector.
+# EMBEDDING_CACHE_MAX = 10_000
+# _embedding_cache: OrderedDict[tuple[str, str], bytes] = OrderedDict()
+
+# async def get_embedding(texts: list[str]) -> list[list[float]]:
+#     keys = [(EMBEDDING_MODEL_NAME, blake3(t.encode('utf-8')).hexdigest()) for t in texts]
+#     embeddings = {}
+#     missing = {}
+#     for key, text in zip(keys, texts):
+#         cached = _embedding_cache.get(key)
+#         if cached is not None:
+#             _embedding_cache.move_to_end(key)
+#             embeddings[key] = np.frombuffer(cached, dtype=np.float16).astype(np.float32).tolist()
+#         else:
+#             missing.setdefault(key, text)
+
+#     if missing:
+#         missing_texts = list(missing.values())
+#         batches = await asyncio.gather(*[
+#             _embed_batch(missing_texts[i:i + EMBEDDING_BATCH_SIZE])
+#             for i in range(0, len(missing_texts), EMBEDDING_BATCH_SIZE)
+#         ])
+#         for key, embedding in zip(missing, (e for batch in batches for e in batch)):
+#             embeddings[key] = embedding
+#             _embedding_cache[key] = np.asarray(embedding, dtype=np.float16).tobytes()
+#             if len(_embedding_cache) > EMBEDDING_CACHE_MAX:
+#                 _embedding_cache.popitem(last=False)
+
+#     return [embeddings[key] for key in keys]
+
+# # Embeddings are stored as pgvector halfvec (FP16, 3 KB per 1536-dim vector instead of 6 KB);
+# # cosine similarity is robust to the rounding. Values are sent at FP16 precision in halfvec's text
+# # input format, which is about a third of the characters of full float reprs.
+# def format_vector(embedding: list[float]) -> str:
+#     return "[" + ",".join(map(str, np.asarray(embedding, dtype=np.float16))) + "]"
 
 # def hash_content(content: str) -> str:
 #     return hashlib.sha256(content.encode('utf-8')).hexdigest()
 
-# @app.post("/upload_pdf/")
-# async def upload_pdf(file: UploadFile = File(...), session_id: str = None):
+# # Fingerprint of the raw upload; only used for dedup, so a fast non-adversarial hash is enough.
+# # Hashed chunk by chunk so the upload is never held in memory as a single bytes object.
+# async def hash_file(file: UploadFile) -> str:
+#     hasher = blake3()
+#     while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+#         hasher.update(chunk)
+#     await file.seek(0)
+#     return hasher.hexdigest()
+
+# # Bounded LRU of hashes known to be in the database, so repeat uploads skip the dedup query
+# SEEN_HASHES_MAX = 100_000
+# _seen_hashes: OrderedDict[str, None] = OrderedDict()
+
+# def hash_seen(content_hash: str) -> bool:
+#     if content_hash in _seen_hashes:
+#         _seen_hashes.move_to_end(content_hash)
+#         return True
+#     return False
+
+# def remember_hash(content_hash: str):
+#     _seen_hashes[content_hash] = None
+#     _seen_hashes.move_to_end(content_hash)
+#     if len(_seen_hashes) > SEEN_HASHES_MAX:
+#         _seen_hashes.popitem(last=False)
+
+# # Background job state lives in Postgres (upload_jobs, see schema.sql) so any uvicorn worker can
+# # answer /status/{id}. The work itself runs in-process, so a restart abandons running jobs: a job
+# # still "processing" after JOB_STALE_SECONDS is reported as failed. Rows older than
+# # JOB_RETENTION_DAYS are pruned.
+# JOB_STALE_SECONDS = 3600
+# JOB_RETENTION_DAYS = 7
+# async def set_job_status(job_id: str, status: str, ids: list = None, detail: str = None):
+#     await db_pool.execute(
+#         """
+#         INSERT INTO upload_jobs (id, status, ids, detail) VALUES ($1, $2, $3, $4)
+#         ON CONFLICT (id) DO UPDATE
+#             SET status = EXCLUDED.status, ids = EXCLUDED.ids, detail = EXCLUDED.detail, updated_at = now()
+#         """,
+#         job_id, status, [str(i) for i in ids] if ids is not None else None, detail
+#     )
+
+# async def prune_jobs():
+#     while True:
+#         try:
+#             await db_pool.execute(
+#                 "DELETE FROM upload_jobs WHERE updated_at < now() - make_interval(days => $1)",
+#                 JOB_RETENTION_DAYS
+#             )
+#         except Exception as e:
+#             logger.error("Error pruning upload jobs: %s", e)
+#         await asyncio.sleep(3600)
+
+# # embedding is a halfvec column (see format_vector and schema.sql)
+# INSERT_CHUNKS_SQL = """
+#     INSERT INTO pdf (session_id, content, content_hash, file_hash, chunk_index, message,
+#                      embedding, metadata, file_name)
+#     SELECT $1, c.content, $2, $3, c.chunk_index, NULL, c.embedding::halfvec, '{}', $4
+#     FROM unnest($5::text[], $6::int[], $7::text[])
+#         AS c(content, chunk_index, embedding)
+#     ON CONFLICT (content_hash, chunk_index) DO NOTHING
+#     RETURNING id
+# """
+
+# async def process_pdf(job_id: str, pdf_file: BinaryIO, file_hash: str, file_name: str, session_id: str):
 #     start_time = time.time()
 #     try:
-#         if not file.filename.endswith(".pdf"):
-#             raise HTTPException(status_code=400, detail="Only PDF files are allowed.")
-
-#         content_bytes = await file.read()
-#         logging.info(f"Read file in {time.time() - start_time:.2f}s")
+#         text = await extract_text_from_pdf(pdf_file)
+#         logger.info("Extracted text length=%d in %.2fs", len(text), time.time() - start_time)
 
-#         text = extract_text_from_pdf(content_bytes)
-#         logging.info(f"Extracted text length={len(text)} in {time.time() - start_time:.2f}s")
+#         # Scanned PDFs have no text layer; nothing to embed, and their (empty) hash must not be cached
+#         if not text:
+#             await set_job_status(job_id, status="failed", detail="No extractable text found in the PDF.")
+#             return
 
 #         content_hash = hash_content(text)
 
-#         # Check if content_hash already exists
-#         existing = supabase.from_("pdf").select("id").eq("content_hash", content_hash).execute()
-#         if existing.data and len(existing.data) > 0:
-#             return {"message": "This PDF content already exists in the database."}
+#         # Known duplicates are skipped locally; anything else is settled atomically by the insert below
+#         if hash_seen(content_hash):
+#             await set_job_status(job_id, status="duplicate")
+#             return
 
-#         embedding_vector = get_embedding(text)
-#         logging.info(f"Got embedding in {time.time() - start_time:.2f}s")
+#         chunks = chunk_text(text)
+#         embedding_vectors = await get_embedding(chunks)
+#         logger.info("Got %d embeddings in %.2fs", len(chunks), time.time() - start_time)
 
-#         insert_data = {
-#             "session_id": session_id or "default",
-#             "content": text,
-#             "content_hash": content_hash,
-#             "message": None,
-#             "embedding": embedding_vector,
-#             "metadata": {},
-#             "file_name": file.filename
-#         }
+#         # One round trip for all chunk rows; the unique (content_hash, chunk_index) index skips any row
+#         # that already exists (including one racing with a concurrent upload). If any row conflicted the
+#         # content is already stored, possibly chunked differently, so roll back rather than mix old and new chunks.
+#         try:
+#             async with db_pool.acquire() as conn:
+#                 tr = conn.transaction()
+#                 await tr.start()
+#                 try:
+#                     rows = await conn.fetch(
+#                         INSERT_CHUNKS_SQL, session_id, content_hash, file_hash, file_name, chunks,
+#                         list(range(len(chunks))), [format_vector(v) for v in embedding_vectors]
+#                     )
+#                 except BaseException:
+#                     await tr.rollback()
+#                     raise
+#                 if len(rows) != len(chunks):
+#                     await tr.rollback()
+#                 else:
+#                     await tr.commit()
+#         except asyncpg.PostgresError as e:
+#             logger.error("Database insert error for job %s: %s", job_id, e)
+#             await set_job_status(job_id, status="failed", detail=f"Database insert error: {e}")
+#             return
+#         if len(rows) != len(chunks):
+#             # Only the content hash is in the database; this file's hash was never stored
+#             remember_hash(content_hash)
+#             await set_job_status(job_id, status="duplicate")
+#             return
+#         ids = [row["id"] for row in rows]
 
-#         result = supabase.from_("pdf").insert(insert_data).execute()
-#         if result.error:
-#             raise HTTPException(status_code=500, detail=f"Supabase insert error: {result.error.message}")
+#         remember_hash(file_hash)
+#         remember_hash(content_hash)
+#         logger.info("Inserted to DB in %.2fs", time.time() - start_time)
+#         await set_job_status(job_id, status="done", ids=ids)
 
-#         logging.info(f"Inserted to DB in {time.time() - start_time:.2f}s")
-#         return {"message": "PDF uploaded and embedded successfully.", "id": result.data[0]["id"]}
+#     except Exception as e:
+#         logger.error("Error processing job %s: %s", job_id, e)
+#         await set_job_status(job_id, status="failed", detail=f"Internal server error: {e}")
+#     finally:
+#         pdf_file.close()
 
+# @app.post("/upload_pdf/", status_code=202)
+# async def upload_pdf(background_tasks: BackgroundTasks, response: Response, file: UploadFile = File(...), session_id: str = None):
+#     start_time = time.time()
+#     try:
+#         if not file.filename.endswith(".pdf"):
+#             raise HTTPException(status_code=400, detail="Only PDF files are allowed.")
+
+#         file_hash = await hash_file(file)
+#         logger.info("Read file in %.2fs", time.time() - start_time)
+
+#         # Check the raw file first so duplicate uploads skip extraction and embedding entirely
+#         # (column and index are created by schema.sql)
+#         # Duplicates are answered right away, so they get 200 rather than the route's 202
+#         if hash_seen(file_hash):
+#             response.status_code = 200
+#             return {"message": "This PDF content already exists in the database."}
+#         existing = await db_pool.fetchval("SELECT id FROM pdf WHERE file_hash = $1 LIMIT 1", file_hash)
+#         if existing is not None:
+#             remember_hash(file_hash)
+#             response.status_code = 200
+#             return {"message": "This PDF content already exists in the database."}
+
+#         # The upload is closed once the response is sent, so keep our own copy for the job
+#         # (process_pdf closes it; until the task is queued, close it here on failure)
+#         pdf_file = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+#         try:
+#             while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+#                 pdf_file.write(chunk)
+
+#             # Extraction, embedding and the insert run after the response, so the client only waits for the upload
+#             job_id = uuid.uuid4().hex
+#             await set_job_status(job_id, status="processing")
+#         except BaseException:
+#             pdf_file.close()
+#             raise
+#         background_tasks.add_task(process_pdf, job_id, pdf_file, file_hash, file.filename, session_id or "default")
+#         return {"id": job_id, "status": "processing"}
+
+#     except HTTPException:
+#         raise
 #     except Exception as e:
-#         logging.error(f"Error in upload_pdf: {e}")
+#         logger.error("Error in upload_pdf: %s", e)
 #         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
+# @app.get("/status/{job_id}")
+# async def job_status(job_id: str):
+#     job = await db_pool.fetchrow(
+#         """
+#         SELECT status, ids, detail, updated_at < now() - make_interval(secs => $2) AS stale
+#         FROM upload_jobs WHERE id = $1
+#         """,
+#         job_id, JOB_STALE_SECONDS
+#     )
+#     if job is None:
+#         raise HTTPException(status_code=404, detail="Unknown job id.")
+#     if job["status"] == "processing" and job["stale"]:
+#         return {"id": job_id, "status": "failed", "detail": "Job was interrupted before it finished."}
+#     return {"id": job_id, **{k: job[k] for k in ("status", "ids", "detail") if job[k] is not None}}
@@ -0,0 +1,45 @@
+-- Columns and indexes the upload pipeline in main.py relies on.
+-- Run against the Supabase database (e.g. psql "$SUPABASE_DB_URL" -f schema.sql).
+-- CREATE INDEX CONCURRENTLY cannot run inside a transaction, so run this file without one.
+
+ALTER TABLE pdf ADD COLUMN IF NOT EXISTS file_hash text;
+ALTER TABLE pdf ADD COLUMN IF NOT EXISTS chunk_index integer NOT NULL DEFAULT 0;
+-- Store embeddings as FP16 halfvec (half the bytes of vector); 1536 dims for text-embedding-3-small
+ALTER TABLE pdf ALTER COLUMN embedding TYPE halfvec(1536) USING embedding::halfvec(1536);
+
+-- Dedup lookups: SELECT id FROM pdf WHERE file_hash = $1 / WHERE content_hash = $1.
+-- Each document is stored as one row per chunk, so uniqueness is per (content_hash, chunk_index);
+-- content_hash is the leading column, so the content_hash lookup uses this index too.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pdf_file_hash_idx ON pdf (file_hash);
+
+-- The old SELECT-then-insert path could race and store the same content twice, and pre-chunking rows
+-- all have chunk_index 0, so the unique index below fails while such duplicates exist. Check first:
+--   SELECT content_hash, chunk_index, count(*) FROM pdf GROUP BY 1, 2 HAVING count(*) > 1;
+-- and if it returns rows, deliberately run this one-off cleanup, which keeps one (arbitrary) row per group:
+--   DELETE FROM pdf a
+--   USING pdf b
+--   WHERE a.content_hash = b.content_hash
+--     AND a.chunk_index = b.chunk_index
+--     AND a.ctid > b.ctid;
+
+-- If a concurrent build fails it leaves an INVALID index behind, which IF NOT EXISTS would then skip.
+-- Find it with: SELECT indexrelid::regclass FROM pg_index WHERE NOT indisvalid;
+-- drop it with DROP INDEX CONCURRENTLY pdf_content_hash_chunk_idx; and re-run this statement.
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS pdf_content_hash_chunk_idx ON pdf (content_hash, chunk_index);
+
+-- Retrieval over the pgvector embedding column (same INVALID-index caveat as above)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS pdf_embedding_hnsw_idx
+    ON pdf USING hnsw (embedding halfvec_cosine_ops) WITH (m = 16, ef_construction = 64);
+
+-- Background upload jobs polled through GET /status/{id}; shared by every uvicorn worker.
+CREATE TABLE IF NOT EXISTS upload_jobs (
+    id text PRIMARY KEY,
+    status text NOT NULL,
+    ids text[],
+    detail text,
+    created_at timestamptz NOT NULL DEFAULT now(),
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- The app prunes rows by updated_at (JOB_RETENTION_DAYS in main.py)
+CREATE INDEX IF NOT EXISTS upload_jobs_updated_at_idx ON upload_jobs (updated_at);